@@ -651,7 +651,7 @@ class Site:
         else:
             usehorizon  = True
             azimuths    = np.linspace(0, 360, 361)
-            userhorizon = list(self.horizon["funcs"](azimuths))
+            userhorizon = np.asarray(self.horizon["func"](azimuths), dtype=float).tolist()
             self.horizon["was_used_for_climate_data"] = True
 
 
@@ -6,14 +6,213 @@ obtained from PVGIS.
 """
 
 #%%                       IMPORTATION OF LIBRARIES
+import os
+import hashlib
+import tempfile
+import warnings
 import numpy as np
 import pvlib as pv
 import pandas as pd
-from scipy.interpolate import interp1d
+from functools import lru_cache
+from scipy.interpolate import BSpline, make_interp_spline
+from solrad.auxiliary_funcs import save_obj_with_pickle, load_obj_with_pickle
+
+#%%                 DEFINITION OF CONSTANTS
+
+# Directory where the raw PVGIS TMY responses are cached.
+PVGIS_TMY_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "solrad", "pvgis")
+
+# Version of the format of the cached files. It is part of their names
+# (along with the pandas version, since pickled DataFrames are not portable
+# across pandas versions), so that stale files are simply never read.
+_PVGIS_TMY_CACHE_VERSION = 1
 
 #%%                 DEFINITION OF FUNCTIONS
 
-def get_pvgis_tmy_dataframe(latitude, longitude, tz, startyear, endyear, usehorizon = False, userhorizon = None):
+@lru_cache(maxsize=32)
+def _get_cached_pvgis_tmy(latitude, longitude, startyear, endyear, usehorizon, userhorizon):
+
+  """
+  Get the raw TMY data from PVGIS, going through the local cache first.
+  The data is only requested from PVGIS if it is not found in the
+  directory *PVGIS_TMY_CACHE_DIR*, in which case it is saved there for
+  later use. Cached files that cannot be read are discarded and the data
+  is requested again.
+
+  Parameters
+  ----------
+  latitude : float
+    Site's latitude in degrees. Must be a number between -90 and 90.
+
+  longitude : float
+    Site's longitude in degrees. Must be a number between -180 and 180.
+
+  startyear: int or None
+    First year to calculate TMY.
+
+  endyear : int or None
+    Last year to calculate TMY, must be at least 10 years from first year.
+
+  usehorizon : bool
+    Wether to include effects of horizon.
+
+  userhorizon : tuple of float or None
+    User specified elevation of horizon in degrees. It must be a tuple
+    (rather than a list) so that the arguments are hashable.
+
+  Returns
+  -------
+  tmy_data : pandas.DataFrame obj of floats
+    Raw PVGIS TMY data, as returned by ``pvlib.iotools.get_pvgis_tmy``.
+    Its index is given in UTC time.
+
+  """
+
+  if userhorizon is None:
+    horizon_str = "None"
+  else:
+    horizon_str = hashlib.md5(repr(userhorizon).encode()).hexdigest()[:12]
+
+  filename = f"{latitude}_{longitude}_{startyear}_{endyear}_{usehorizon}_{horizon_str}"
+  filename = f"{filename}_v{_PVGIS_TMY_CACHE_VERSION}_pandas{pd.__version__}.pkl"
+  path = os.path.join(PVGIS_TMY_CACHE_DIR, filename)
+
+  if os.path.isfile(path):
+    try:
+      return load_obj_with_pickle(path)
+
+    except Exception as m:
+      msg = f"Discarding unreadable cached PVGIS TMY data at '{path}': {m!r}"
+      warnings.warn(msg)
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  tmy_data = pv.iotools.get_pvgis_tmy(latitude = latitude,
+                                      longitude = longitude,
+                                      usehorizon = usehorizon,
+                                      userhorizon = None if userhorizon is None else list(userhorizon),
+                                      startyear = startyear,
+                                      endyear = endyear,
+                                      outputformat = 'csv',
+                                      map_variables = True)[0]
+
+  # The data is first written to a temporary file, which is then moved to
+  # its final path, so that an interrupted write never leaves a partial
+  # file behind at 'path'.
+  tmp_path = None
+  try:
+    os.makedirs(PVGIS_TMY_CACHE_DIR, exist_ok = True)
+    fd, tmp_path = tempfile.mkstemp(suffix = ".tmp", dir = PVGIS_TMY_CACHE_DIR)
+    os.close(fd)
+    save_obj_with_pickle(tmy_data, tmp_path)
+    os.replace(tmp_path, path)
+
+  except OSError as m:
+    msg = f"Could not cache PVGIS TMY data at '{path}': {m}"
+    warnings.warn(msg)
+    if tmp_path is not None and os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+  return tmy_data
+
+
+
+def _interp_linear_kernel(Y, day_ids, hms, out):
+
+  """
+  Linearly interpolate hourly tables, sampled at hours 0, 1, ..., 24, at
+  the requested local times of day.
+
+  Parameters
+  ----------
+  Y : numpy.array of floats with shape (n_days, 25, ncols)
+    Hourly values of each climate variable, for each day.
+
+  day_ids : numpy.array of ints with shape (npoints,)
+    Index (along the first axis of *Y*) of the day to be used for each point.
+
+  hms : numpy.array of floats with shape (npoints,)
+    Local time of day, in hours, of each point. Values must lie between 0 and 24.
+
+  out : numpy.array of floats with shape (npoints, ncols)
+    Array where the result is written.
+
+  Returns
+  -------
+  out : numpy.array of floats with shape (npoints, ncols)
+    Interpolated values of each climate variable at each point.
+
+  """
+
+  idx  = np.clip(hms.astype(int), 0, Y.shape[1] - 2)
+  frac = (hms - idx)[:,np.newaxis]
+
+  # out = y0 + frac*(y1 - y0), computed in place.
+  np.subtract(Y[day_ids, idx + 1], Y[day_ids, idx], out = out)
+  out *= frac
+  out += Y[day_ids, idx]
+
+  return out
+
+
+
+def _interp_bspline_kernel(t, c, k, day_ids, hms, out):
+
+  """
+  Evaluate B-splines of degree k, one for each day, at the requested local
+  times of day.
+
+  Parameters
+  ----------
+  t : numpy.array of floats with shape (ncoeffs + k + 1,)
+    Knots of the B-splines. They are the same for all days.
+
+  c : numpy.array of floats with shape (ncoeffs, n_days, ncols)
+    B-spline coefficients of each climate variable, for each day.
+
+  k : int
+    Degree of the B-splines.
+
+  day_ids : numpy.array of ints with shape (npoints,)
+    Index (along the second axis of *c*) of the day to be used for each point.
+
+  hms : numpy.array of floats with shape (npoints,)
+    Local time of day, in hours, of each point. Values must lie between 0 and 24.
+
+  out : numpy.array of floats with shape (npoints, ncols)
+    Array where the result is written.
+
+  Returns
+  -------
+  out : numpy.array of floats with shape (npoints, ncols)
+    Interpolated values of each climate variable at each point.
+
+  """
+
+  # Only the k+1 basis functions B_{s-k}, ..., B_s can be non-zero at a
+  # point lying in the knot interval [t_s, t_{s+1}). Their values are taken
+  # from the design matrix, without relying on how its entries are stored.
+  n_coef = len(t) - k - 1
+  start  = np.clip(np.searchsorted(t, hms, side="right") - 1, k, n_coef - 1) - k
+
+  design_matrix = BSpline.design_matrix(hms, t, k).tocoo()
+  offset = design_matrix.col - start[design_matrix.row]
+  keep   = (offset >= 0) & (offset <= k)
+
+  basis = np.zeros((len(hms), k+1))
+  basis[design_matrix.row[keep], offset[keep]] = design_matrix.data[keep]
+
+  out[:] = 0
+  for j in range(k+1):
+    out += basis[:,j,np.newaxis]*c[start + j, day_ids]
+
+  return out
+
+
+
+def get_pvgis_tmy_dataframe(latitude, longitude, tz, startyear, endyear, usehorizon = False, userhorizon = None, use_cache = True):
 
   """
   Get Typical Meteorological Year (TMY) data from PVGIS.
@@ -42,6 +241,12 @@ def get_pvgis_tmy_dataframe(latitude, longitude, tz, startyear, endyear, usehori
     Optional user specified elevation of horizon in degrees, at equally spaced azimuth values, clockwise 
     from north. It is only valid if usehorizon is true. If usehorizon is true but userhorizon is None then 
     PVGIS will calculate the horizon.
+
+  use_cache : bool, optional
+    Wether to reuse previously downloaded PVGIS data for the same query.
+    If True, the raw PVGIS response is looked up in memory and then in the
+    directory given by *PVGIS_TMY_CACHE_DIR*, and it is only requested from
+    PVGIS (and stored there) if not found. Default is True.
       
   Returns
   -------
@@ -122,14 +327,30 @@ def get_pvgis_tmy_dataframe(latitude, longitude, tz, startyear, endyear, usehori
   # WD10m: 10-m wind direction (0 = N, 90 = E) (degree)
   # SP: Surface (air) pressure (Pa)
 
-  tmy_data = pv.iotools.get_pvgis_tmy(latitude = latitude,
-                                      longitude = longitude,
-                                      usehorizon = usehorizon,
-                                      userhorizon = userhorizon,
-                                      startyear = startyear,
-                                      endyear = endyear,
-                                      outputformat = 'csv',
-                                      map_variables = True)[0]
+  # Since the response of PVGIS is the same for the same query, it is
+  # cached (both in memory and on disk) in order to avoid downloading the
+  # data again.
+
+  if use_cache:
+    if userhorizon is not None:
+      userhorizon = tuple(np.asarray(userhorizon, dtype=float).tolist())
+
+    tmy_data = _get_cached_pvgis_tmy(latitude = latitude,
+                                     longitude = longitude,
+                                     startyear = startyear,
+                                     endyear = endyear,
+                                     usehorizon = usehorizon,
+                                     userhorizon = userhorizon).copy()
+
+  else:
+    tmy_data = pv.iotools.get_pvgis_tmy(latitude = latitude,
+                                        longitude = longitude,
+                                        usehorizon = usehorizon,
+                                        userhorizon = userhorizon,
+                                        startyear = startyear,
+                                        endyear = endyear,
+                                        outputformat = 'csv',
+                                        map_variables = True)[0]
 
 
   # At this point 'tmy_data' is a DataFrame consisting of 8760 rows.
@@ -139,32 +360,38 @@ def get_pvgis_tmy_dataframe(latitude, longitude, tz, startyear, endyear, usehori
   # terms of greenwhich median time. We then have to convert it to local
   # time:
 
-  new_tmy_index = tmy_data.index.tz_convert(tz)
-  tmy_data = tmy_data.reindex(new_tmy_index)
+  tmy_data.index = tmy_data.index.tz_convert(tz)
+
+  # We change the names of the columns to give them more standard names
+  # and keep only the columns of interest. Doing it before sorting means
+  # that less data has to be moved around.
+  new_cols_dict = {"temp_air":"T2m", "relative_humidity":"RH", "ghi":"G(h)",
+                    "dni":"Gb(n)", "dhi":"Gd(h)", "wind_speed":"WS10m",
+                    "wind_direction":"WD10m", "pressure":"SP"}
+
+  tmy_cols = ["T2m", "RH", "G(h)", "Gb(n)", "Gd(h)", "IR(h)", "WS10m", "WD10m", "SP"]
+
+  tmy_data.rename(columns=new_cols_dict, inplace=True)
+  tmy_data = tmy_data[tmy_cols]
 
   # After the time index conversion, we sort the values, in hierarchical
-  # order, by Month, Day and Hour:
+  # order, by Month, Day and Hour. Encoding the three of them into a single
+  # integer key lets us get the sorting order with one argsort:
 
-  tmy_data["Date"] = tmy_data.index
+  months = tmy_data.index.month.to_numpy().astype("int16")
+  days   = tmy_data.index.day.to_numpy().astype("int8")
+  hours  = tmy_data.index.hour.to_numpy().astype("int8")
 
-  tmy_data["Month"] = tmy_data["Date"].apply(lambda x:x.month)
-  tmy_data["Day"]   = tmy_data["Date"].apply(lambda x:x.day)
-  tmy_data["Hour"]  = tmy_data["Date"].apply(lambda x:x.hour)
+  key   = months.astype("int32")*10000 + days.astype("int32")*100 + hours
+  order = np.argsort(key, kind="stable")
 
-  tmy_data = tmy_data.sort_values(by=["Month", "Day", "Hour"])
-  tmy_data.drop(columns=["Date"], inplace=True)
+  tmy_data = tmy_data.take(order)
 
   # We then create a Multiindex for the DataFrame. In this way we may
   # access any value by specifying the Month, Day and Hour.
 
-  tmy_data = tmy_data.set_index(["Month", "Day", "Hour"])
-
-  # We change the names of the columns to give them more standard names:
-  new_cols_dict = {"temp_air":"T2m", "relative_humidity":"RH", "ghi":"G(h)",
-                    "dni":"Gb(n)", "dhi":"Gd(h)", "wind_speed":"WS10m",
-                    "wind_direction":"WD10m", "pressure":"SP"}
-
-  tmy_data = tmy_data.rename(columns=new_cols_dict)
+  tmy_data.index = pd.MultiIndex.from_arrays([months[order], days[order], hours[order]],
+                                             names = ["Month", "Day", "Hour"])
 
 
   return tmy_data
@@ -172,7 +399,7 @@ def get_pvgis_tmy_dataframe(latitude, longitude, tz, startyear, endyear, usehori
 
 
 
-def climate_data_from_pvgis_tmy_dataframe(time_data, tmy_data, interp_method = "linear"):
+def climate_data_from_pvgis_tmy_dataframe(time_data, tmy_data, interp_method = "linear", return_arrays = False):
 
   """
   Generate climate data from PVGIS TMY (Time Meteorological Year) DataFrame,
@@ -191,6 +418,11 @@ def climate_data_from_pvgis_tmy_dataframe(time_data, tmy_data, interp_method = "
   interp_method : {'linear', 'quadratic', 'cubic'}, optional
       The interpolation method to be used. Defaults is 'linear'.
 
+  return_arrays : bool, optional
+      If True, the climate data of each date is returned as a plain numpy.array
+      of floats, rather than as a pandas.DataFrame, which avoids the overhead
+      of building the DataFrames. Default is False.
+
   Returns
   -------
   climate_data : dict
@@ -198,7 +430,13 @@ def climate_data_from_pvgis_tmy_dataframe(time_data, tmy_data, interp_method = "
       The keys are the same as for *time_data*. The corresponding values are pandas.DataFrames whose
       index are the pandas.DatetimeIndex objects contained in *time_data* and whose columns
       contain the climate variables from *tmy_data*, interpolated and evaluated at each
-      time step.
+      time step. If *return_arrays* is True, the values are instead numpy.arrays
+      of floats with shape (len(DatetimeIndex_obj), 1 + ncols).
+
+  columns : tuple of str
+      Names of the columns of the arrays contained in *climate_data*, that is,
+      "hms_float" followed by the columns of *tmy_data*. Only returned if
+      *return_arrays* is True.
 
   See Also
   --------
@@ -232,42 +470,123 @@ def climate_data_from_pvgis_tmy_dataframe(time_data, tmy_data, interp_method = "
   climate_data = {}
   x_interp = np.arange(25)
 
+  # The names of the columns are the same for every date, so they are
+  # computed only once.
+  col_names   = tuple(tmy_data.columns)
+  columns     = ("hms_float",) + col_names
+  out_columns = pd.Index(columns)
+
+  # We gather the TMY data of each day (plus the first hour of the next
+  # day) into a single (25, ncols) array, so that all climate variables
+  # can be interpolated at once. The rows of 'tmy_data' are scattered by
+  # (Month, Day, Hour) into a (n_days, 24, ncols) grid, which is done only
+  # once, before looping over the simulation dates. Some days may be
+  # incomplete (e.g, when the TMY February comes from a leap year and the
+  # time zone has a positive UTC offset). Those days simply get no table
+  # and only the simulation dates that need them fail.
+  months = tmy_data.index.get_level_values("Month").to_numpy().astype(int)
+  days   = tmy_data.index.get_level_values("Day").to_numpy().astype(int)
+  hours  = tmy_data.index.get_level_values("Hour").to_numpy().astype(int)
+  ncols  = len(col_names)
+
+  day_keys, inverse = np.unique(months*100 + days, return_inverse = True)
+  day_keys = [(int(key // 100), int(key % 100)) for key in day_keys]
+  n_days   = len(day_keys)
+
+  day_tables = np.full((n_days, 25, ncols), np.nan)
+  day_tables[inverse, hours, :] = tmy_data.to_numpy(dtype=np.float64, copy=False)
+
+  has_hour = np.zeros((n_days, 24), dtype=bool)
+  has_hour[inverse, hours] = True
+  is_complete = has_hour.all(axis=1) & (np.bincount(inverse, minlength = n_days) == 24)
+
+  # The first hour of the next day is looked up in the same way as one
+  # would do it by hand: the next day of the same month, else the 1st of
+  # the next month, else the 1st of January.
+  key_ids = {key : i for i, key in enumerate(day_keys)}
+  day_ids = {}
+  for i, (month, day) in enumerate(day_keys):
+    if not is_complete[i]:
+      continue
+
+    for next_key in [(month, day+1), (month+1, 1), (1, 1)]:
+      if next_key in key_ids and has_hour[key_ids[next_key], 0]:
+        day_tables[i,24] = day_tables[key_ids[next_key],0]
+        day_ids[(month, day)] = i
+        break
+
+  # Only the complete tables are kept, so that the spline fits below never
+  # see the NaNs of the incomplete days.
+  day_tables = day_tables[list(day_ids.values())]
+  day_ids    = {key : i for i, key in enumerate(day_ids)}
+
+
+  # We gather the local time of day of all simulation dates into a single
+  # flat array, along with the TMY day that corresponds to each of them.
+  dates, hms_floats, query_day_ids = [], [], []
   for (year, month, day), DatetimeIndex_obj in time_data.items():
 
-    hms_float  = DatetimeIndex_obj.hour
-    hms_float += DatetimeIndex_obj.minute/60
-    hms_float += DatetimeIndex_obj.second/3600
-
-    climate_data[(year, month, day)] = pd.DataFrame(index   = DatetimeIndex_obj,
-                columns = ["hms_float"] + list(tmy_data.columns))
-
-    climate_data[(year, month, day)]["hms_float" ] = hms_float
-
+    # Local time of day, in hours, computed in one go from the elapsed time
+    # since midnight (independently of the resolution of the index).
+    local_time = DatetimeIndex_obj.tz_localize(None)
+    hms_float  = ((local_time - local_time.normalize()) / pd.Timedelta(hours=1)).to_numpy()
 
     day_ = day
     if (month, day) == (2, 29):
       day_ = 28
 
-
-    for col in tmy_data.columns:
-      y_interp = list(tmy_data.loc[(month, day_), col])
-
-      try:
-        y_interp.append(tmy_data.loc[(month, day_+1, 0), col])
-
-      except KeyError:
-        try:
-          y_interp.append(tmy_data.loc[(month+1, 1, 0), col])
-
-        except KeyError:
-          try:
-            y_interp.append(tmy_data.loc[(1, 1, 0), col])
-
-          except Exception as m:
-            raise(m)
-
-      interp_func = interp1d(x_interp, y_interp, kind = interp_method)
-      climate_data[(year, month, day)][col] = interp_func(hms_float)
+    if (month, day_) not in day_ids:
+      msg = f"tmy_data has no complete hourly data (hours 0 to 23 plus hour 0 of the next day) for month {month}, day {day_}"
+      raise Exception(msg)
+
+    dates.append((year, month, day))
+    hms_floats.append(hms_float)
+    query_day_ids.append(day_ids[(month, day_)])
+
+  if not dates:
+    return (climate_data, columns) if return_arrays else climate_data
+
+  lengths  = np.array([len(hms_float) for hms_float in hms_floats])
+  bounds   = np.concatenate([[0], np.cumsum(lengths)])
+  query_x  = np.concatenate(hms_floats)
+  query_id = np.repeat(query_day_ids, lengths)
+
+  # The whole output is written into a single float array, whose first
+  # column is 'hms_float' and the rest are the interpolated climate
+  # variables.
+  arr = np.empty((len(query_x), len(columns)))
+  arr[:,0] = query_x
+
+  # Since the x-axis of the interpolation (i.e, the hours of the day) is
+  # the same for every day, linear interpolation can be carried out for
+  # all simulation dates at once.
+  if interp_method == "linear":
+    _interp_linear_kernel(day_tables, query_id, query_x, arr[:,1:])
+
+  # Otherwise, the spline coefficients of all days are computed at once
+  # (the system to be solved is the same for every day, only the
+  # right-hand side changes) and then evaluated at all points.
+  elif interp_method in ["quadratic", "cubic"]:
+    k = {"quadratic" : 2, "cubic" : 3}[interp_method]
+    spline = make_interp_spline(x_interp, day_tables, k = k, axis = 1)
+    _interp_bspline_kernel(spline.t, spline.c, k, query_id, query_x, arr[:,1:])
+
+  else:
+    msg = f"interp_method must be one of 'linear', 'quadratic' or 'cubic', not '{interp_method}'"
+    raise Exception(msg)
+
+
+  if return_arrays:
+    for i, date in enumerate(dates):
+      climate_data[date] = arr[bounds[i]:bounds[i+1]]
+
+    return climate_data, columns
+
+  for i, date in enumerate(dates):
+    climate_data[date] = pd.DataFrame(arr[bounds[i]:bounds[i+1]],
+                         index   = time_data[date],
+                         columns = out_columns,
+                         copy    = False)
 
   return climate_data
 
@@ -0,0 +1,162 @@
+#%%              IMPORTATION OF LIBRARIES
+import os
+import pytest
+import numpy as np
+import pandas as pd
+import solrad.climate.pvgis_tmy as pvgty
+
+#%%           DEFINITION OF CONSTANTS
+
+LAT, LON = 6.2518, -75.5636
+
+# Columns of the raw PVGIS TMY data, as returned by pvlib.
+PVGIS_COLS = ["temp_air", "relative_humidity", "ghi", "dni", "dhi", "IR(h)",
+              "wind_speed", "wind_direction", "pressure"]
+
+#%%           DEFINITION OF AUXILIARY FUNCTIONS
+
+def synthetic_pvgis_tmy():
+   # 8760 hourly rows (UTC), each month taken from a different year, just
+   # like the data returned by PVGIS.
+   years = [2007, 2012, 2009, 2010, 2011, 2006, 2008, 2013, 2005, 2014, 2010, 2009]
+   index = []
+   for month, year in enumerate(years, 1):
+      start = pd.Timestamp(year, month, 1, tz="UTC")
+      index.append(pd.date_range(start, start + pd.offsets.MonthBegin(1), freq="h", inclusive="left"))
+   index = index[0].append(index[1:])
+   index = index[~((index.month == 2) & (index.day == 29))]
+
+   rng = np.random.default_rng(0)
+   return pd.DataFrame(100*rng.random((len(index), len(PVGIS_COLS))), index=index, columns=PVGIS_COLS)
+
+
+@pytest.fixture
+def fake_pvgis(monkeypatch, tmp_path):
+   # Replace the PVGIS query with synthetic data and cache to a temporary
+   # directory. It yields the list of calls made to the (fake) PVGIS.
+   calls = []
+   raw_data = synthetic_pvgis_tmy()
+
+   def fake_get_pvgis_tmy(**kwargs):
+      calls.append(kwargs)
+      return raw_data.copy(), None, None, None
+
+   monkeypatch.setattr(pvgty.pv.iotools, "get_pvgis_tmy", fake_get_pvgis_tmy)
+   monkeypatch.setattr(pvgty, "PVGIS_TMY_CACHE_DIR", str(tmp_path))
+   pvgty._get_cached_pvgis_tmy.cache_clear()
+   yield calls
+   pvgty._get_cached_pvgis_tmy.cache_clear()
+
+#%%                     PYTESTS
+
+def test_get_pvgis_tmy_dataframe_cache(fake_pvgis, tmp_path):
+   calls = fake_pvgis
+   kwargs = dict(latitude=LAT, longitude=LON, startyear=2005, endyear=2015)
+
+   # The raw (UTC) data is cached, so changing the time zone reuses it.
+   tmy_data0 = pvgty.get_pvgis_tmy_dataframe(tz="-05:00", **kwargs)
+   tmy_data1 = pvgty.get_pvgis_tmy_dataframe(tz="+05:00", **kwargs)
+   assert len(calls) == 1
+   assert len(tmy_data0) == len(tmy_data1) == 8760
+
+   # A different horizon is a different query.
+   pvgty.get_pvgis_tmy_dataframe(tz="-05:00", usehorizon=True, userhorizon=[1.0, 2.0, 3.0], **kwargs)
+   assert len(calls) == 2
+   assert calls[-1]["userhorizon"] == [1.0, 2.0, 3.0]
+   assert len(os.listdir(tmp_path)) == 2
+
+   # The files on disk are reused once the in-memory cache is cleared.
+   pvgty._get_cached_pvgis_tmy.cache_clear()
+   tmy_data2 = pvgty.get_pvgis_tmy_dataframe(tz="-05:00", **kwargs)
+   assert len(calls) == 2
+   pd.testing.assert_frame_equal(tmy_data0, tmy_data2)
+
+   # Without cache, PVGIS is always queried.
+   pvgty.get_pvgis_tmy_dataframe(tz="-05:00", use_cache=False, **kwargs)
+   assert len(calls) == 3
+
+
+def test_get_pvgis_tmy_dataframe_corrupt_cache(fake_pvgis, tmp_path):
+   calls = fake_pvgis
+   kwargs = dict(latitude=LAT, longitude=LON, tz="-05:00", startyear=2005, endyear=2015)
+
+   tmy_data0 = pvgty.get_pvgis_tmy_dataframe(**kwargs)
+   filename, = os.listdir(tmp_path)
+   with open(os.path.join(tmp_path, filename), "wb") as f:
+      f.write(b"\x80\x05partial")
+
+   pvgty._get_cached_pvgis_tmy.cache_clear()
+   with pytest.warns(UserWarning, match="unreadable cached PVGIS TMY data"):
+      tmy_data1 = pvgty.get_pvgis_tmy_dataframe(**kwargs)
+
+   assert len(calls) == 2
+   pd.testing.assert_frame_equal(tmy_data0, tmy_data1)
+
+   # The bad file was replaced by a good one.
+   pvgty._get_cached_pvgis_tmy.cache_clear()
+   pvgty.get_pvgis_tmy_dataframe(**kwargs)
+   assert len(calls) == 2
+   assert os.listdir(tmp_path) == [filename]
+
+
+def test_climate_data_from_pvgis_tmy_dataframe_return_arrays(fake_pvgis):
+   tmy_data = pvgty.get_pvgis_tmy_dataframe(latitude=LAT, longitude=LON, tz="-05:00",
+                                            startyear=2005, endyear=2015, use_cache=False)
+   ncols = len(tmy_data.columns)
+
+   time_data = {}
+   for date in pd.date_range("2023-12-30", "2024-01-02", freq="D"):
+      time_data[(date.year, date.month, date.day)] =\
+      pd.date_range(date + pd.Timedelta("6h"), date + pd.Timedelta("18h"), freq="5min", tz="-05:00")
+
+   # A day with no time steps.
+   time_data[(2024, 2, 29)] = pd.DatetimeIndex([], tz="-05:00")
+
+   for interp_method in ["linear", "quadratic", "cubic"]:
+      climate_data = pvgty.climate_data_from_pvgis_tmy_dataframe(time_data, tmy_data, interp_method)
+      res = pvgty.climate_data_from_pvgis_tmy_dataframe(time_data, tmy_data, interp_method, return_arrays=True)
+
+      assert isinstance(res, tuple) and len(res) == 2
+      arrays, columns = res
+      assert columns == ("hms_float",) + tuple(tmy_data.columns)
+      assert arrays.keys() == time_data.keys()
+
+      for date, DatetimeIndex_obj in time_data.items():
+         hms_float = (DatetimeIndex_obj.hour + DatetimeIndex_obj.minute/60).to_numpy()
+         assert arrays[date].shape == (len(DatetimeIndex_obj), 1 + ncols)
+         assert arrays[date][:,0] == pytest.approx(hms_float)
+         assert list(climate_data[date].columns) == list(columns)
+         np.testing.assert_array_equal(arrays[date], climate_data[date].to_numpy())
+
+   # No dates at all.
+   assert pvgty.climate_data_from_pvgis_tmy_dataframe({}, tmy_data) == {}
+   assert pvgty.climate_data_from_pvgis_tmy_dataframe({}, tmy_data, return_arrays=True) ==\
+          ({}, ("hms_float",) + tuple(tmy_data.columns))
+
+
+def test_climate_data_from_pvgis_tmy_dataframe_incomplete_days(fake_pvgis):
+   # The TMY February of the synthetic data comes from a leap year (2012)
+   # while March comes from 2009. With a UTC+ offset, local Feb 29 only gets
+   # hours 0 to 4 and local Mar 1 only gets hours 5 to 23.
+   tmy_data = pvgty.get_pvgis_tmy_dataframe(latitude=LAT, longitude=LON, tz="+05:00",
+                                            startyear=2005, endyear=2015, use_cache=False)
+   assert len(tmy_data.loc[(2, 29)]) == 5
+   assert len(tmy_data.loc[(3, 1)])  == 19
+
+   DatetimeIndex_obj = pd.date_range("2023-06-01 06:00", "2023-06-01 18:00", freq="5min", tz="+05:00")
+   hms_float = (DatetimeIndex_obj.hour + DatetimeIndex_obj.minute/60).to_numpy()
+
+   # Complete days are still served, with the same values as interpolating
+   # the hourly data of the day (plus hour 0 of the next day) by hand.
+   climate_data = pvgty.climate_data_from_pvgis_tmy_dataframe({(2023, 6, 1): DatetimeIndex_obj}, tmy_data)
+   for col in tmy_data.columns:
+      y_interp = list(tmy_data.loc[(6, 1), col]) + [tmy_data.loc[(6, 2, 0), col]]
+      expected = np.interp(hms_float, np.arange(25), y_interp)
+      assert climate_data[(2023, 6, 1)][col].to_numpy() == pytest.approx(expected)
+
+   # Only the date whose TMY day is missing hours fails.
+   DatetimeIndex_obj = pd.date_range("2023-03-01 06:00", "2023-03-01 18:00", freq="h", tz="+05:00")
+   with pytest.raises(Exception, match="no complete hourly data"):
+      pvgty.climate_data_from_pvgis_tmy_dataframe({(2023, 3, 1): DatetimeIndex_obj}, tmy_data)
+
+# %%